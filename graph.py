@@ -1,13 +1,24 @@
 import os
-import json
-from typing import TypedDict, List, Optional
-from langchain_core.messages import AnyMessage, SystemMessage, HumanMessage, ToolMessage, AIMessage
-from langchain_core.prompts import ChatPromptTemplate
+import re
+import functools
+import sys
+import logging
+import httpx
+import orjson
+from dataclasses import dataclass, field, replace
+from typing import Annotated, Final, TypedDict, List, Optional, Union
+from langchain_core.messages import AnyMessage, SystemMessage, HumanMessage, ToolMessage, AIMessage, filter_messages, trim_messages
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_groq import ChatGroq
+from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import StateGraph, END
+from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode, tools_condition
+from langgraph.types import Send
+from pydantic import BaseModel, Field
 
-from tools import search_airbnb, book_airbnb, create_google_calendar_event
+from tools import AirbnbListing, to_iso_date, search_airbnb, book_airbnb, create_google_calendar_event
 
 # Define the state for the graph
 class UserPreferences(TypedDict):
@@ -17,63 +28,175 @@ class UserPreferences(TypedDict):
     adults: int
     children: int
 
-class AirbnbSearchResult(TypedDict):
-    name: str
-    price: float
-    rating: float
-    url: str
+class Choice(BaseModel):
+    """A model to represent the user's choice."""
+    choice: int = Field(description="The user's choice of which Airbnb to book, as an integer.")
 
-class AgentState(TypedDict):
-    user_preferences: Optional[UserPreferences]
-    search_results: Optional[List[AirbnbSearchResult]]
-    chosen_airbnb: Optional[AirbnbSearchResult]
-    booking_confirmation: Optional[str]
-    calendar_event_id: Optional[str]
-    messages: List[AnyMessage]
+@dataclass(slots=True)
+class AgentState:
+    user_preferences: Optional[UserPreferences] = None
+    search_results: Optional[List[AirbnbListing]] = None
+    chosen_airbnb: Optional[AirbnbListing] = None
+    booking_confirmation: Optional[str] = None
+    calendar_event_id: Optional[str] = None
+    messages: Annotated[List[AnyMessage], add_messages] = field(default_factory=list)
 
 # Initialize the model and tools
 groq_api_key = os.environ.get("GROQ_API_KEY")
-model = ChatGroq(model="llama3-8b-8192", groq_api_key=groq_api_key)
+# One pooled HTTP client per mode, shared by every chain, so concurrent calls
+# reuse kept-alive TCP/TLS connections instead of opening new ones
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=50)
+model = ChatGroq(
+    model="llama3-8b-8192",
+    groq_api_key=groq_api_key,
+    http_client=httpx.Client(limits=_HTTP_LIMITS, timeout=30.0),
+    http_async_client=httpx.AsyncClient(limits=_HTTP_LIMITS, timeout=30.0),
+    max_retries=2,
+)
 tools = [search_airbnb, book_airbnb, create_google_calendar_event]
 tool_executor = ToolNode(tools)
 
-# Utility function to complete a tool call
-def complete_tool_call(tool_name, **kwargs):
-    tool = {
-        "search_airbnb": search_airbnb,
-        "book_airbnb": book_airbnb,
-        "create_google_calendar_event": create_google_calendar_event,
-    }[tool_name]
+logger = logging.getLogger(__name__)
 
-    observation = tool.invoke(kwargs)
+# Preference keys are interned once so the parser's lookups compare by pointer
+_PREF_KEYS: Final = tuple(sys.intern(key) for key in ("city", "date_from", "date_to", "adults", "children"))
 
-    return ToolMessage(
-        content=json.dumps(observation, indent=2),
-        name=tool_name,
-        tool_call_id="12345", # Dummy tool_call_id
+# Static system prompts. These are sent first, followed by the prior turns and
+# then the new user turn, so everything but the last message is byte-identical
+# to the previous call and Groq's automatic prefix cache can serve it.
+_PREF_SYSTEM: Final[str] = (
+    "You are an expert at extracting user preferences for booking an Airbnb. "
+    "Extract the city, check-in date, check-out date, number of adults, and number of children from the user's message. "
+    "If any information is missing, ask clarifying questions. "
+    "Respond with a JSON object with the keys city, date_from, date_to, adults and children, "
+    "using null for any value the user has not given."
+)
+_CHOICE_SYSTEM: Final[str] = (
+    "You are an expert at understanding a user's choice from a list of options. "
+    "The user will be presented with a list of Airbnbs and will be asked to choose one to book. "
+    "Your job is to extract the number of the choice they want to book. "
+    "If the user wants to refine the search or asks for different options, you should indicate that. "
+    "If the user does not want to book, you should end the conversation."
+)
+
+# Memoized per schema so the structured-output wrapper and its JSON schema are built once per process
+@functools.cache
+def _structured(schema):
+    return model.with_structured_output(schema, include_raw=True)
+
+# Upper bound on the prior turns sent with each extraction call
+HISTORY_MAX_TOKENS: Final[int] = 2048
+
+# Build the extraction chains once at import time
+_PREF_PROMPT = ChatPromptTemplate.from_messages(
+    [SystemMessage(content=_PREF_SYSTEM), MessagesPlaceholder("history"), ("user", "{input}")]
+)
+_PREF_CHAIN = _PREF_PROMPT | model.bind(response_format={"type": "json_object"})
+
+_CHOICE_PROMPT = ChatPromptTemplate.from_messages(
+    [SystemMessage(content=_CHOICE_SYSTEM), MessagesPlaceholder("history"), ("user", "{input}")]
+)
+_CHOICE_CHAIN = _CHOICE_PROMPT | _structured(Choice)
+
+# Fast paths for decide_next_step that avoid an LLM round-trip
+_CHOICE_RE = re.compile(r"\b([1-3])\b")
+_REFINE_RE = re.compile(r"\b(more|different)\b")
+
+# Whole-word yes/no classification shared by the routers
+_WORD_RE = re.compile(r"[a-z]+")
+_YES: Final = frozenset({"yes", "y", "sure", "yep", "ok", "okay", "please", "confirm"})
+_NO: Final = frozenset({"no", "n", "nope", "cancel", "skip"})
+_NEGATIONS: Final = frozenset({"not", "don", "never", "except", "instead"})
+
+def log_cache_usage(node: str, response: AIMessage):
+    """
+    Logs how many prompt tokens Groq served from its prefix cache.
+    """
+    metadata = response.response_metadata
+    usage = (metadata.get("x_groq") or {}).get("usage") or metadata.get("token_usage") or {}
+    prompt_tokens = usage.get("prompt_tokens")
+    if not prompt_tokens:
+        return
+
+    cached_tokens = usage.get("cached_tokens")
+    if cached_tokens is None:
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+    logger.info(
+        "%s prompt cache: %d/%d tokens cached (%.0f%%)",
+        node, cached_tokens, prompt_tokens, 100 * cached_tokens / prompt_tokens,
     )
 
+# JSON helpers backed by orjson
+def _dumps(obj) -> str:
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
+_loads = orjson.loads
+
+def parse_user_preferences(content: str) -> UserPreferences:
+    """
+    Parses the model's JSON reply into UserPreferences without schema validation.
+    Dates are normalized to ISO 8601 once here so downstream nodes can use them as-is.
+    Fields that are missing or of the wrong type (city and dates must be strings,
+    adults and children non-negative integers) are set to None so the graph asks for them.
+    """
+    data = _loads(content)
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object of user preferences.")
+
+    user_preferences = {key: data.get(key) for key in _PREF_KEYS}
+    city = user_preferences["city"]
+    if not isinstance(city, str) or not city.strip():
+        user_preferences["city"] = None
+    for key in ("date_from", "date_to"):
+        value = user_preferences[key]
+        user_preferences[key] = to_iso_date(value) if isinstance(value, str) else None
+    for key in ("adults", "children"):
+        value = user_preferences[key]
+        # bool is a subclass of int, and floats like 2.7 must not be truncated
+        if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+            user_preferences[key] = None
+    return user_preferences
+
+def last_user_message(state: AgentState) -> str:
+    """
+    Returns the content of the most recent human message.
+    """
+    for message in reversed(state.messages):
+        if isinstance(message, HumanMessage):
+            return message.content
+    return ""
+
+def conversation_history(state: AgentState) -> List[AnyMessage]:
+    """
+    Returns the human and assistant turns before the most recent human message,
+    trimmed to the last HISTORY_MAX_TOKENS tokens.
+    The conversation is append-only, so until the window fills this extends the previous call's prefix.
+    """
+    for i in range(len(state.messages) - 1, -1, -1):
+        if isinstance(state.messages[i], HumanMessage):
+            history = filter_messages(state.messages[:i], include_types=[HumanMessage, AIMessage])
+            return trim_messages(
+                history,
+                max_tokens=HISTORY_MAX_TOKENS,
+                token_counter=count_tokens_approximately,
+                strategy="last",
+                start_on="human",
+            )
+    return []
+
 # Define the nodes for the graph
-def get_user_preferences(state: AgentState):
+async def get_user_preferences(state: AgentState):
     """
     Extracts user preferences from the conversation history.
     """
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                "You are an expert at extracting user preferences for booking an Airbnb. "
-                "Extract the city, check-in date, check-out date, number of adults, and number of children from the user's message. "
-                "If any information is missing, ask clarifying questions."
-            ),
-            ("user", "{input}"),
-        ]
+    response = await _PREF_CHAIN.ainvoke(
+        {"history": conversation_history(state), "input": last_user_message(state)}
     )
-
-    structured_llm = model.with_structured_output(UserPreferences)
-    chain = prompt | structured_llm
-
-    user_preferences = chain.invoke({"input": state["messages"][-1].content})
+    log_cache_usage("get_user_preferences", response)
+    try:
+        user_preferences = parse_user_preferences(response.content)
+    except ValueError:
+        user_preferences = None
 
     return {"user_preferences": user_preferences, "messages": []}
 
@@ -81,11 +204,19 @@ def search_for_airbnbs(state: AgentState):
     """
     Searches for Airbnbs based on the user's preferences.
     """
-    preferences = state["user_preferences"]
-    tool_message = complete_tool_call("search_airbnb", **preferences)
+    preferences = state.user_preferences
+
+    # Call the tool functions directly; the arguments come from our own state,
+    # so LangChain's tool dispatch and argument validation are not needed.
+    observation = search_airbnb.func(**preferences)
+    tool_message = ToolMessage(
+        content=_dumps(observation),
+        name="search_airbnb",
+        tool_call_id="12345", # Dummy tool_call_id
+    )
 
     return {
-        "search_results": json.loads(tool_message.content),
+        "search_results": observation,
         "messages": [AIMessage(content="Searching for Airbnbs..."), tool_message],
     }
 
@@ -93,28 +224,68 @@ def present_choices(state: AgentState):
     """
     Presents the top 3 Airbnb choices to the user.
     """
-    search_results = state["search_results"]
+    search_results = state.search_results
     message_content = "Here are the top 3 Airbnb listings I found:\n\n"
     for i, result in enumerate(search_results[:3]):
-        message_content += f"{i+1}. {result['name']} - ${result['price']}/night, Rating: {result['rating']}\n"
+        message_content += f"{i+1}. {result.name} - ${result.price}/night, Rating: {result.rating}\n"
 
-    return {"messages": [AIMessage(content=message_content)]}
+    return {"messages": [AIMessage(content=message_content, name="present_choices")]}
+
+def confirm_booking(state: AgentState):
+    """
+    Records the chosen Airbnb and asks the user to confirm the booking.
+    """
+    chosen_airbnb = state.chosen_airbnb
+    preferences = state.user_preferences
+    message_content = (
+        f"Great choice: {chosen_airbnb.name} (${chosen_airbnb.price}/night) "
+        f"from {preferences['date_from']} to {preferences['date_to']}. "
+        "Shall I book it?"
+    )
+
+    return {
+        "chosen_airbnb": chosen_airbnb,
+        "booking_confirmation": None,
+        "calendar_event_id": None,
+        "messages": [AIMessage(content=message_content, name="confirm_booking")],
+    }
+
+def ask_calendar(state: AgentState):
+    """
+    Asks whether to also create a calendar event for the confirmed booking.
+    """
+    message_content = "Would you like me to add this stay to your Google Calendar as well?"
+    return {"messages": [AIMessage(content=message_content, name="ask_calendar")]}
+
+def cancel_booking(state: AgentState):
+    """
+    Drops the chosen Airbnb after the user declined the booking.
+    """
+    message_content = "Okay, I won't book it. Let me know if you'd like to see other options."
+    return {"chosen_airbnb": None, "messages": [AIMessage(content=message_content)]}
 
 def book_airbnb_node(state: AgentState):
     """
     Books the chosen Airbnb and confirms with the user.
     """
-    preferences = state["user_preferences"]
-    chosen_airbnb = state["chosen_airbnb"]
-
-    tool_message = complete_tool_call(
-        "book_airbnb",
-        listing_url=chosen_airbnb["url"],
-        **preferences,
+    preferences = state.user_preferences
+    chosen_airbnb = state.chosen_airbnb
+
+    observation = book_airbnb.func(
+        listing_url=chosen_airbnb.url,
+        date_from=preferences["date_from"],
+        date_to=preferences["date_to"],
+        adults=preferences["adults"],
+        children=preferences["children"],
+    )
+    tool_message = ToolMessage(
+        content=_dumps(observation),
+        name="book_airbnb",
+        tool_call_id="12345", # Dummy tool_call_id
     )
 
     return {
-        "booking_confirmation": json.loads(tool_message.content),
+        "booking_confirmation": observation,
         "messages": [AIMessage(content="Booking the Airbnb..."), tool_message],
     }
 
@@ -122,22 +293,36 @@ def create_calendar_event_node(state: AgentState):
     """
     Creates a Google Calendar event for the booking.
     """
-    preferences = state["user_preferences"]
-    chosen_airbnb = state["chosen_airbnb"]
+    preferences = state.user_preferences
+    chosen_airbnb = state.chosen_airbnb
 
-    tool_message = complete_tool_call(
-        "create_google_calendar_event",
-        summary=f"Airbnb Booking: {chosen_airbnb['name']}",
+    observation = create_google_calendar_event.func(
+        summary=f"Airbnb Booking: {chosen_airbnb.name}",
         start_time=f"{preferences['date_from']}T09:00:00",
         end_time=f"{preferences['date_to']}T11:00:00",
-        description=f"Booking confirmation for {chosen_airbnb['name']}.",
+        description=f"Booking confirmation for {chosen_airbnb.name}.",
+    )
+    tool_message = ToolMessage(
+        content=_dumps(observation),
+        name="create_google_calendar_event",
+        tool_call_id="12345", # Dummy tool_call_id
     )
 
     return {
-        "calendar_event_id": json.loads(tool_message.content),
+        "calendar_event_id": observation,
         "messages": [AIMessage(content="Creating Google Calendar event..."), tool_message],
     }
 
+def finalize(state: AgentState):
+    """
+    Joins the booking and calendar branches and reports the outcome.
+    """
+    message_content = state.booking_confirmation
+    if state.calendar_event_id:
+        message_content += f" Calendar event created: {state.calendar_event_id}."
+
+    return {"messages": [AIMessage(content=message_content)]}
+
 # Define the graph
 workflow = StateGraph(AgentState)
 
@@ -145,66 +330,141 @@ workflow = StateGraph(AgentState)
 workflow.add_node("get_user_preferences", get_user_preferences)
 workflow.add_node("search_for_airbnbs", search_for_airbnbs)
 workflow.add_node("present_choices", present_choices)
+workflow.add_node("confirm_booking", confirm_booking)
+workflow.add_node("ask_calendar", ask_calendar)
+workflow.add_node("cancel_booking", cancel_booking)
 workflow.add_node("book_airbnb", book_airbnb_node)
 workflow.add_node("create_calendar_event", create_calendar_event_node)
+workflow.add_node("finalize", finalize)
 
 # Define the edges
-workflow.set_entry_point("get_user_preferences")
 workflow.add_edge("search_for_airbnbs", "present_choices")
+workflow.add_edge("present_choices", END)
+workflow.add_edge("confirm_booking", END)
+workflow.add_edge("ask_calendar", END)
+workflow.add_edge("cancel_booking", END)
 
 # Define conditional logic
 def should_search(state: AgentState) -> str:
     """
     Determines whether to search for Airbnbs or ask for more information.
+    A value of 0 (e.g. no children) counts as given.
     """
-    if state.get("user_preferences") and all(state["user_preferences"].values()):
+    preferences = state.user_preferences or {}
+    if all(preferences.get(key) not in (None, "") for key in _PREF_KEYS):
         return "search"
     return "ask_for_info"
 
-from langchain_core.pydantic_v1 import BaseModel, Field
-
-class Choice(BaseModel):
-    """A model to represent the user's choice."""
-    choice: int = Field(description="The user's choice of which Airbnb to book, as an integer.")
+def awaiting_reply_to(state: AgentState, node: str) -> bool:
+    """
+    Checks whether the latest human message answers the last message posted by `node`.
+    """
+    for i in range(len(state.messages) - 1, -1, -1):
+        if isinstance(state.messages[i], HumanMessage):
+            break
+    else:
+        return False
+    for message in reversed(state.messages[:i]):
+        if isinstance(message, AIMessage):
+            return message.name == node
+    return False
+
+def classify_reply(state: AgentState) -> Optional[bool]:
+    """
+    Classifies the latest user message as yes (True), no (False) or unclear (None).
+    Any negation wins over affirmative words, so "no please don't" is a no.
+    """
+    tokens = set(_WORD_RE.findall(last_user_message(state).lower()))
+    if tokens & (_NO | _NEGATIONS):
+        return False
+    if tokens & _YES:
+        return True
+    return None
+
+def decide_booking(state: AgentState) -> str:
+    """
+    Handles the reply to the booking confirmation: only an explicit yes moves on.
+    """
+    if _REFINE_RE.search(last_user_message(state).lower()):
+        return "refine_search"
+    reply = classify_reply(state)
+    if reply is True:
+        return "ask_calendar"
+    if reply is False:
+        return "cancel"
+    return "confirm_booking"
+
+def dispatch_booking(state: AgentState) -> Union[str, List[Send]]:
+    """
+    Fans out the confirmed booking and, if the user agreed, calendar creation in parallel.
+    Both only need the preferences and the chosen Airbnb.
+    """
+    if _REFINE_RE.search(last_user_message(state).lower()):
+        return "refine_search"
+    sends = [Send("book_airbnb", state)]
+    if should_create_calendar_event(state) == "create_event":
+        sends.append(Send("create_calendar_event", state))
+    return sends
+
+def choose_airbnb(state: AgentState, chosen_airbnb: AirbnbListing) -> List[Send]:
+    """
+    Hands the chosen Airbnb to confirm_booking, which asks the user to confirm it.
+    """
+    return [Send("confirm_booking", replace(state, chosen_airbnb=chosen_airbnb))]
 
-def decide_next_step(state: AgentState) -> str:
+async def route_entry(state: AgentState) -> Union[str, List[Send]]:
+    """
+    Routes each new user message to the step that asked for it.
+    """
+    if awaiting_reply_to(state, "present_choices"):
+        return await decide_next_step(state)
+    if awaiting_reply_to(state, "confirm_booking"):
+        return decide_booking(state)
+    if awaiting_reply_to(state, "ask_calendar"):
+        return dispatch_booking(state)
+    return "get_user_preferences"
+
+async def decide_next_step(state: AgentState) -> Union[str, List[Send]]:
     """
     Decides the next step based on the user's response after seeing the choices.
     """
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                "You are an expert at understanding a user's choice from a list of options. "
-                "The user will be presented with a list of Airbnbs and will be asked to choose one to book. "
-                "Your job is to extract the number of the choice they want to book. "
-                "If the user wants to refine the search or asks for different options, you should indicate that. "
-                "If the user does not want to book, you should end the conversation."
-            ),
-            ("user", "{input}"),
-        ]
-    )
+    if not awaiting_reply_to(state, "present_choices"):
+        return "end"
 
-    structured_llm = model.with_structured_output(Choice)
-    chain = prompt | structured_llm
+    last_message = last_user_message(state)
+    lowered = last_message.lower()
 
-    last_message = state["messages"][-1].content
+    tokens = set(_WORD_RE.findall(lowered))
+    choices = _CHOICE_RE.findall(lowered)
+    if _REFINE_RE.search(lowered):
+        return "refine_search"
+    if not choices and tokens & _NO:
+        return "cancel"
+
+    # Only trust a bare digit when it is the sole choice and nothing negates it;
+    # mixed replies such as "no, 2 looks great" go to the LLM
+    if len(choices) == 1 and not tokens & (_NO | _NEGATIONS) and int(choices[0]) <= len(state.search_results):
+        return choose_airbnb(state, state.search_results[int(choices[0]) - 1])
 
     try:
-        user_choice = chain.invoke({"input": last_message})
-        state["chosen_airbnb"] = state["search_results"][user_choice.choice - 1]
-        return "book"
+        response = await _CHOICE_CHAIN.ainvoke(
+            {"history": conversation_history(state), "input": last_message}
+        )
+        log_cache_usage("decide_next_step", response["raw"])
+        user_choice = response["parsed"]
     except Exception:
-        if "more" in last_message.lower() or "different" in last_message.lower():
-            return "refine_search"
         return "end"
+    if user_choice is None or not 1 <= user_choice.choice <= len(state.search_results):
+        return "end"
+    chosen_airbnb = state.search_results[user_choice.choice - 1]
+    return choose_airbnb(state, chosen_airbnb)
 
 def should_create_calendar_event(state: AgentState) -> str:
     """
     Checks if the user wants to create a calendar event.
+    Only an explicit yes to the ask_calendar question counts as consent.
     """
-    last_message = state["messages"][-1].content.lower()
-    if "yes" in last_message or "sure" in last_message:
+    if awaiting_reply_to(state, "ask_calendar") and classify_reply(state) is True:
         return "create_event"
     return "end"
 
@@ -214,21 +474,30 @@ workflow.add_conditional_edges(
     should_search,
     {"search": "search_for_airbnbs", "ask_for_info": END},
 )
-workflow.add_conditional_edges(
-    "present_choices",
-    decide_next_step,
-    {"book": "book_airbnb", "refine_search": "get_user_preferences", "end": END},
-)
-workflow.add_conditional_edges(
-    "book_airbnb",
-    should_create_calendar_event,
-    {"create_event": "create_calendar_event", "end": END},
+# The conversation spans several graph runs: each run ends after asking the user
+# something, and the next run starts at the step that reply belongs to.
+# Sends are routed directly; the path map entries only label the edges.
+workflow.set_conditional_entry_point(
+    route_entry,
+    {
+        "get_user_preferences": "get_user_preferences",
+        "confirm_booking": "confirm_booking",
+        "ask_calendar": "ask_calendar",
+        "cancel": "cancel_booking",
+        "book_airbnb": "book_airbnb",
+        "create_calendar_event": "create_calendar_event",
+        "refine_search": "get_user_preferences",
+        "end": END,
+    },
 )
-workflow.add_edge("create_calendar_event", END)
+workflow.add_edge("book_airbnb", "finalize")
+workflow.add_edge("create_calendar_event", "finalize")
+workflow.add_edge("finalize", END)
 
 
-# Compile the graph
-app = workflow.compile()
+# Compile the graph. The checkpointer keeps the state between the user's turns.
+app = workflow.compile(checkpointer=MemorySaver())
 
-# Print the graph to a file for visualization
-app.get_graph().print_ascii()
\ No newline at end of file
+# Print the graph for visualization when LANGGRAPH_PRINT_ASCII=1
+if os.environ.get("LANGGRAPH_PRINT_ASCII") == "1":
+    app.get_graph().print_ascii()
\ No newline at end of file
@@ -1,19 +1,31 @@
 import os
+import asyncio
+import logging
+import uuid
+from typing import Final
 from dotenv import load_dotenv
-from langchain_core.messages import AnyMessage, SystemMessage, HumanMessage
+from langchain_core.messages import AnyMessage, SystemMessage, HumanMessage, AIMessage
 from graph import app
 
 # Load environment variables from .env file
 load_dotenv()
 
-def main():
+# Set LOG_LEVEL=INFO to see per-call prompt cache hit ratios
+if os.environ.get("LOG_LEVEL"):
+    logging.basicConfig(level=os.environ["LOG_LEVEL"].upper())
+
+# Kept constant so the start of every conversation is byte-identical
+GREETING: Final[str] = "Hello! I'm here to help you book an Airbnb and create a Google Calendar event for your trip. What are your travel plans?"
+
+async def main():
     """
     Main function to run the Airbnb booking agent.
     """
-    # Set up the initial state
-    messages: list[AnyMessage] = [
-        SystemMessage(content="Hello! I'm here to help you book an Airbnb and create a Google Calendar event for your trip. What are your travel plans?")
-    ]
+    # The graph's checkpointer keeps the conversation for this thread, so each turn
+    # only sends the new messages. The checkpointed history is append-only: earlier
+    # messages are never edited, so each turn's prompt extends the previous one and stays cacheable.
+    config = {"configurable": {"thread_id": str(uuid.uuid4())}}
+    messages: list[AnyMessage] = [SystemMessage(content=GREETING)]
 
     while True:
         # Get user input
@@ -24,21 +36,22 @@ def main():
         # Add user message to the state
         messages.append(HumanMessage(content=user_input))
 
-        # Invoke the graph
-        for event in app.stream({"messages": messages}):
+        # Invoke the graph, printing each node's message as soon as that node completes
+        async for event in app.astream({"messages": messages}, config, stream_mode="updates"):
             for value in event.values():
-                if isinstance(value["messages"][-1], HumanMessage):
+                if not value or not value.get("messages"):
+                    continue
+                # Only assistant messages are for the user; tool results are reported by finalize
+                if not isinstance(value["messages"][-1], AIMessage):
                     continue
 
                 # Check if the message is not empty before printing
                 if value["messages"][-1].content:
                     print("Assistant:", value["messages"][-1].content)
-
-                messages.append(value["messages"][-1])
-
+        messages = []
 
 if __name__ == "__main__":
     # Check if the GROQ_API_KEY is set
     if not os.environ.get("GROQ_API_KEY"):
         raise ValueError("GROQ_API_KEY environment variable not set.")
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
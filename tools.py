@@ -1,11 +1,87 @@
 import os
+import functools
+from dataclasses import dataclass
+from datetime import date, datetime
+from dateutil import parser as dateutil_parser
 from langchain_core.tools import tool
-from typing import List, Dict, Any
-import json
+from typing import Final, List, Optional, Tuple
+from pydantic import BaseModel, ConfigDict, Field
+
+@dataclass(slots=True, frozen=True)
+class AirbnbListing:
+    """A single Airbnb search result."""
+    name: str
+    price: float
+    rating: float
+    url: str
+
+# Argument schemas for the tools. Defining them up front builds the Pydantic v2
+# validators once at import instead of inferring them from each function signature.
+class SearchArgs(BaseModel):
+    model_config = ConfigDict(extra="forbid", validate_assignment=False, strict=True)
+
+    city: str = Field(description="The city to search for listings in.")
+    date_from: str = Field(description="The check-in date.")
+    date_to: str = Field(description="The check-out date.")
+    adults: int = Field(description="The number of adults.")
+    children: int = Field(description="The number of children.")
+
+class BookArgs(BaseModel):
+    model_config = ConfigDict(extra="forbid", validate_assignment=False, strict=True)
+
+    listing_url: str = Field(description="The URL of the listing to book.")
+    date_from: str = Field(description="The check-in date.")
+    date_to: str = Field(description="The check-out date.")
+    adults: int = Field(description="The number of adults.")
+    children: int = Field(description="The number of children.")
+
+class CalendarEventArgs(BaseModel):
+    model_config = ConfigDict(extra="forbid", validate_assignment=False, strict=True)
+
+    summary: str = Field(description="The title of the event.")
+    start_time: str = Field(description="The start time of the event in ISO 8601 format.")
+    end_time: str = Field(description="The end time of the event in ISO 8601 format.")
+    description: Optional[str] = Field(default=None, description="The description of the event.")
+
+# Two different fallback dates: any field dateutil fills from the default differs between them
+_DATE_DEFAULTS: Final = (datetime(2001, 1, 1), datetime(2002, 2, 2))
+
+@functools.lru_cache(maxsize=256)
+def to_iso_date(value: str) -> Optional[str]:
+    """
+    Returns the date in canonical ISO 8601 form (YYYY-MM-DD), or None if it cannot be parsed
+    or is missing its year, month or day.
+    """
+    value = value.strip()
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        pass
+    try:
+        parsed = [dateutil_parser.parse(value, default=default).date() for default in _DATE_DEFAULTS]
+    except (ValueError, OverflowError):
+        return None
+    if parsed[0] != parsed[1]:
+        return None
+    return parsed[0].isoformat()
+
+# Results are cached on the normalized arguments so an unchanged search skips the API call.
+# A real API should use a TTL cache instead (e.g. cachetools.TTLCache(maxsize=1024, ttl=300)),
+# since prices change over time.
+@functools.lru_cache(maxsize=256)
+def _search_airbnb_cached(city: str, date_from: str, date_to: str, adults: int, children: int) -> Tuple[AirbnbListing, ...]:
+    print(f"Searching for Airbnb in {city} from {date_from} to {date_to} for {adults} adults and {children} children.")
+    # In a real-world scenario, this would call the Airbnb API.
+    # For this example, we'll return a list of mock listings.
+    return (
+        AirbnbListing(name="Cozy Apartment in the City Center", price=120.0, rating=4.8, url="https://www.airbnb.com/rooms/1"),
+        AirbnbListing(name="Spacious Loft with a View", price=200.0, rating=4.9, url="https://www.airbnb.com/rooms/2"),
+        AirbnbListing(name="Charming Cottage near the Park", price=95.0, rating=4.7, url="https://www.airbnb.com/rooms/3"),
+    )
 
 # Mock functions for Airbnb
-@tool("search_airbnb", return_direct=False)
-def search_airbnb(city: str, date_from: str, date_to: str, adults: int, children: int) -> List[Dict[str, Any]]:
+@tool("search_airbnb", args_schema=SearchArgs, return_direct=False)
+def search_airbnb(city: str, date_from: str, date_to: str, adults: int, children: int) -> List[AirbnbListing]:
     """
     Searches for Airbnb listings with the given parameters.
 
@@ -17,18 +93,17 @@ def search_airbnb(city: str, date_from: str, date_to: str, adults: int, children
         children: The number of children.
 
     Returns:
-        A list of dictionaries, where each dictionary represents an Airbnb listing.
+        A list of AirbnbListing objects, one per Airbnb listing.
     """
-    print(f"Searching for Airbnb in {city} from {date_from} to {date_to} for {adults} adults and {children} children.")
-    # In a real-world scenario, this would call the Airbnb API.
-    # For this example, we'll return a list of mock listings.
-    return [
-        {"name": "Cozy Apartment in the City Center", "price": 120.0, "rating": 4.8, "url": "https://www.airbnb.com/rooms/1"},
-        {"name": "Spacious Loft with a View", "price": 200.0, "rating": 4.9, "url": "https://www.airbnb.com/rooms/2"},
-        {"name": "Charming Cottage near the Park", "price": 95.0, "rating": 4.7, "url": "https://www.airbnb.com/rooms/3"},
-    ]
+    return list(_search_airbnb_cached(
+        city.strip().lower(),
+        to_iso_date(date_from) or date_from.strip(),
+        to_iso_date(date_to) or date_to.strip(),
+        int(adults),
+        int(children),
+    ))
 
-@tool("book_airbnb", return_direct=False)
+@tool("book_airbnb", args_schema=BookArgs, return_direct=False)
 def book_airbnb(listing_url: str, date_from: str, date_to: str, adults: int, children: int) -> str:
     """
     Books an Airbnb listing.
@@ -48,7 +123,7 @@ def book_airbnb(listing_url: str, date_from: str, date_to: str, adults: int, chi
     # For this example, we'll return a mock confirmation.
     return "Successfully booked the Airbnb listing."
 
-@tool("create_google_calendar_event", return_direct=False)
+@tool("create_google_calendar_event", args_schema=CalendarEventArgs, return_direct=False)
 def create_google_calendar_event(summary: str, start_time: str, end_time: str, description: str = None) -> str:
     """
     Creates a Google Calendar event.